@@ -4,16 +4,17 @@ LSP-specific message routing and merging logic.
 
 from dataclasses import dataclass, field
 from functools import reduce
-from typing import cast
+from typing import Any, Callable, cast
 
 from .json import JSON
 from .util import (
     dmerge,
+    dmerge_into,
     is_scalar,
 )
 
 
-@dataclass
+@dataclass(slots=True)
 class Server:
     """Information about a logical LSP server."""
 
@@ -22,7 +23,7 @@ class Server:
     cookie: object = None
 
 
-@dataclass
+@dataclass(slots=True)
 class PayloadItem:
     """A payload item for aggregation."""
 
@@ -31,16 +32,148 @@ class PayloadItem:
     is_error: bool
 
 
+# Resolve requests whose 'data' may carry an inline stash
+_RESOLVE_METHODS = frozenset(
+    (
+        'completionItem/resolve',
+        'codeAction/resolve',
+        'codeLens/resolve',
+        'documentLink/resolve',
+        'inlayHint/resolve',
+        'workspaceSymbol/resolve',
+    )
+)
+
+# Requests routed to at most one server supporting this capability
+_SINGLE_CAP = {
+    'textDocument/rename': 'renameProvider',
+    'textDocument/formatting': 'documentFormattingProvider',
+    'textDocument/rangeFormatting': 'documentRangeFormattingProvider',
+}
+
+
+def _route_to_all(method: str, params: JSON, servers: list[Server]):
+    """Route to all servers."""
+    return servers
+
+
+def _route_code_action(method: str, params: JSON, servers: list[Server]):
+    """Route to _all_ servers supporting code actions."""
+    return [s for s in servers if s.caps.get('codeActionProvider')]
+
+
+def _route_completion(method: str, params: JSON, servers: list[Server]):
+    """Route to completion providers, honoring trigger characters."""
+    cands = [s for s in servers if s.caps.get('completionProvider')]
+    if len(cands) <= 1:
+        return cands
+    if k := params.get("context", {}).get("triggerCharacter"):
+        return [
+            s
+            for s in cands
+            if (cp := s.caps.get("completionProvider"))
+            and k in cp.get("triggerCharacters", [])
+        ]
+    else:
+        return cands
+
+
+def _route_single_cap(method: str, params: JSON, servers: list[Server]):
+    """Route to at most one server supporting the capability."""
+    cap = _SINGLE_CAP[method]
+    for s in servers:
+        if s.caps.get(cap):
+            return [s]
+    return []
+
+
+_ROUTERS: dict[str, Callable[[str, JSON, list[Server]], list[Server]]] = {
+    # initialize and shutdown go to all servers
+    'initialize': _route_to_all,
+    'shutdown': _route_to_all,
+    'textDocument/codeAction': _route_code_action,
+    # Completions is special
+    'textDocument/completion': _route_completion,
+    **{m: _route_single_cap for m in _SINGLE_CAP},
+}
+
+
+def _t1sync(x) -> bool:
+    """Check if x announces full (type 1) text document sync."""
+    return x == 1 or (isinstance(x, dict) and x.get("change") == 1)
+
+
+def _merge_cap(cur: Any, new: Any) -> Any:
+    """Merge two values of a capability.
+    Non-scalars win over scalars; dicts are merged; cur wins otherwise."""
+    if is_scalar(cur) and not is_scalar(new):
+        return new
+    if isinstance(cur, dict) and isinstance(new, dict):
+        # FIXME: This generic merging needs work. For example,
+        # if one server has hoverProvider: true and another
+        # has hoverProvider: {"workDoneProgress": true}, the
+        # result should be {"workDoneProgress": false} to
+        # retain the truish value while not announcing a
+        # capability that one server doesn't support. However,
+        # the correct merging strategy likely varies per
+        # capability.
+        return dmerge(cur, new)
+    return cur
+
+
+def _merge_cap_unmerged(cur: Any, new: Any) -> Any:
+    """Like `_merge_cap', but never merge dicts."""
+    if is_scalar(cur) and not is_scalar(new):
+        return new
+    return cur
+
+
+def _merge_text_document_sync(cur: Any, new: Any) -> Any:
+    """Like `_merge_cap', but full text document sync wins."""
+    return new if _t1sync(new) else _merge_cap(cur, new)
+
+
+# Capabilities needing a merge strategy other than `_merge_cap'
+_CAP_MERGERS: dict[str, Callable[[Any, Any], Any]] = {
+    'textDocumentSync': _merge_text_document_sync,
+    'semanticTokensProvider': _merge_cap_unmerged,
+}
+
+
 class LspLogic:
     """Decide on message routing and response aggregation."""
 
+    __slots__ = (
+        'servers',
+        'document_versions',
+        '_pending_versions',
+        '_notif_handlers',
+        '_aggregators',
+    )
+
     def __init__(self, servers: list[Server]):
         """Initialize with all servers."""
         self.servers = servers
         # Track document versions: URI -> version number
         self.document_versions: dict[str, dict] = {}
-        # Map server ID to server object for data recovery
-        self.server_by_id: dict[int, Server] = {id(s): s for s in servers}
+        # Latest versions not yet folded into document_versions
+        self._pending_versions: dict[str, int] = {}
+        # Client notification handlers: method -> handler
+        self._notif_handlers: dict[str, Callable[[JSON], None]] = {
+            'textDocument/didOpen': self._on_did_open_or_change,
+            'textDocument/didChange': self._on_did_open_or_change,
+            'textDocument/didClose': self._on_did_close,
+        }
+        # Payload aggregators: method -> aggregator
+        self._aggregators: dict[
+            str, Callable[[list[PayloadItem]], JSON | list]
+        ] = {
+            'textDocument/publishDiagnostics': self._aggregate_diagnostics,
+            'textDocument/codeAction': self._aggregate_code_actions,
+            'textDocument/completion': self._aggregate_completions,
+            'initialize': self._aggregate_initialize,
+            'shutdown': self._aggregate_shutdown,
+        }
 
     async def on_client_request(
         self, method: str, params: JSON, servers: list[Server]
@@ -59,51 +192,20 @@ class LspLogic:
         # Check for data recovery from inline stash
         data = (
             params.get('data')
-            if params and method.endswith("resolve")
+            if params and method in _RESOLVE_METHODS
             else None
         )
         if (
             isinstance(data, dict)
-            and (probe := data.get('frassum-server'))
-            and (target := self.server_by_id.get(probe))
+            and type(slot := data.get('frassum-server')) is int
+            and 0 <= slot < len(self.servers)
         ):
             # Replace with original data
             params['data'] = data.get('frassum-data')
-            return [target]
+            return [self.servers[slot]]
 
-        # initialize and shutdown go to all servers
-        if method in ['initialize', 'shutdown']:
-            return servers
-
-        # Route requests to _all_ servers supporting this
-        if method == 'textDocument/codeAction':
-            return [s for s in servers if s.caps.get('codeActionProvider')]
-
-        # Completions is special
-        if method == 'textDocument/completion':
-            cands = [s for s in servers if s.caps.get('completionProvider')]
-            if len(cands) <= 1:
-                return cands
-            if k := params.get("context", {}).get("triggerCharacter"):
-                return [
-                    s
-                    for s in cands
-                    if (cp := s.caps.get("completionProvider"))
-                    and k in cp.get("triggerCharacters", [])
-                ]
-            else:
-                return cands
-
-        # Route these to at most one server supporting this capability
-        if cap := {
-            'textDocument/rename': 'renameProvider',
-            'textDocument/formatting': 'documentFormattingProvider',
-            'textDocument/rangeFormatting': 'documentRangeFormattingProvider',
-        }.get(method):
-            for s in servers:
-                if s.caps.get(cap):
-                    return [s]
-            return []
+        if router := _ROUTERS.get(method):
+            return router(method, params, servers)
 
         # Default: route to primary server
         return [self.servers[0]] if servers else []
@@ -112,31 +214,41 @@ class LspLogic:
         """
         Handle client notifications to track document state.
         """
-        if method == 'textDocument/didOpen':
-            text_doc = params.get('textDocument', {})
-            uri = text_doc.get('uri')
-            version = text_doc.get('version')
-            if uri is not None and version is not None:
-                self.document_versions[uri] = {
-                    'tracked_version': version,
-                    'has_some_diags': False,
-                }
-
-        elif method == 'textDocument/didChange':
-            text_doc = params.get('textDocument', {})
-            uri = text_doc.get('uri')
-            version = text_doc.get('version')
-            if uri is not None and version is not None:
-                self.document_versions[uri] = {
-                    'tracked_version': version,
-                    'has_some_diags': False,
-                }
-
-        elif method == 'textDocument/didClose':
-            text_doc = params.get('textDocument', {})
-            uri = text_doc.get('uri')
-            if uri is not None:
-                self.document_versions.pop(uri, None)
+        if handler := self._notif_handlers.get(method):
+            handler(params)
+
+    def _on_did_open_or_change(self, params: JSON) -> None:
+        """Start tracking a new document version."""
+        try:
+            text_doc = params['textDocument']
+            uri = text_doc['uri']
+            version = text_doc['version']
+        except (KeyError, TypeError):
+            return
+        if uri is not None and version is not None:
+            # Only the latest version matters, so defer the update
+            # until diagnostics need it.
+            self._pending_versions[uri] = version
+
+    def _on_did_close(self, params: JSON) -> None:
+        """Stop tracking a closed document."""
+        try:
+            uri = params['textDocument']['uri']
+        except (KeyError, TypeError):
+            return
+        if uri is not None:
+            self._pending_versions.pop(uri, None)
+            self.document_versions.pop(uri, None)
+
+    def _flush_versions(self) -> None:
+        """Fold pending document versions into document_versions."""
+        dv = self.document_versions
+        for uri, version in self._pending_versions.items():
+            dv[uri] = {
+                'tracked_version': version,
+                'has_some_diags': False,
+            }
+        self._pending_versions.clear()
 
     async def on_client_response(
         self,
@@ -166,10 +278,12 @@ class LspLogic:
         Handle server notifications.
         """
         # Add source attribution to diagnostics
-        if method == 'textDocument/publishDiagnostics':
-            for diag in params.get('diagnostics', []):
-                if 'source' not in diag:
-                    diag['source'] = source.name
+        if method == 'textDocument/publishDiagnostics' and (
+            diags := params.get('diagnostics')
+        ):
+            name = source.name
+            for diag in diags:
+                diag.setdefault('source', name)
 
     async def on_server_response(
         self,
@@ -187,8 +301,9 @@ class LspLogic:
 
         # Stash data fields in codeAction responses
         if method == 'textDocument/codeAction':
+            slot = self._slot_of(server)
             for action in cast(list, payload):
-                self._stash_data_maybe(action, server)
+                self._stash_data_maybe(action, slot)
 
         # Stash data fields in completion responses
         if method == 'textDocument/completion':
@@ -197,8 +312,9 @@ class LspLogic:
                 if isinstance(payload, list)
                 else payload.get('items', [])
             )
+            slot = self._slot_of(server)
             for item in cast(list, items):
-                self._stash_data_maybe(item, server)
+                self._stash_data_maybe(item, slot)
 
         # Extract server name and capabilities from initialize response
         if method == 'initialize':
@@ -216,14 +332,14 @@ class LspLogic:
         Returns "drop" if message should be dropped (stale version).
         """
         if method == 'textDocument/publishDiagnostics':
+            if self._pending_versions:
+                self._flush_versions()
             if (uri := payload.get('uri')) and (
                 probe := self.document_versions.get(uri)
             ):
-                tracked_version = probe["tracked_version"]
+                # Unversioned diagnostics apply to the tracked version
                 version = payload.get('version')
-                if version is None:
-                    version = tracked_version
-                elif version != tracked_version:
+                if version is not None and version != probe["tracked_version"]:
                     return "drop"
                 had_diags = probe["has_some_diags"]
                 probe["has_some_diags"] = True
@@ -258,104 +374,95 @@ class LspLogic:
         # Otherwise, skip errors and aggregate successful responses
         items = [item for item in items if not item.is_error]
 
-        if method == 'textDocument/publishDiagnostics':
-
-            def merge_diags(acc, item):
-                p = cast(JSON, item.payload)
-                for diag in p.get('diagnostics', []):
-                    if 'source' not in diag:
-                        diag['source'] = item.server.name
-                return dmerge(acc, p)
-
-            res = reduce(merge_diags, items, {})
-
-        elif method == 'textDocument/codeAction':
-            res = reduce(
-                lambda acc, item: acc + cast(list, item.payload), items, []
-            )
-
-        elif method == 'textDocument/completion':
-
-            def normalize(x):
-                return x if isinstance(x, dict) else {'items': x}
-
-            # FIXME: Deep merging CompletionList properties is wrong
-            # for many fields (e.g., isIncomplete should probably be OR'd)
-            res = reduce(
-                lambda acc, item: dmerge(acc, normalize(item.payload)),
-                items,
-                {},
-            )
-
-        elif method == 'initialize':
-            res = reduce(
-                lambda acc, item: self._merge_initialize_payloads(
-                    acc, cast(JSON, item.payload), item.server
-                ),
-                items,
-                {},
-            )
+        aggregate = self._aggregators.get(method, self._aggregate_default)
+        return (aggregate(items), False)
+
+    def _aggregate_diagnostics(self, items: list[PayloadItem]) -> JSON:
+        """Aggregate publishDiagnostics params."""
+        res = {}
+        # Extend one list in place rather than concatenating per item
+        diags = []
+        for item in items:
+            p = cast(JSON, item.payload)
+            new_diags = p.get('diagnostics', [])
+            name = item.server.name
+            for diag in new_diags:
+                diag.setdefault('source', name)
+            diags.extend(new_diags)
+            for key, value in p.items():
+                res.setdefault(key, value)
+        res['diagnostics'] = diags
+        return res
+
+    def _aggregate_code_actions(self, items: list[PayloadItem]) -> list:
+        """Aggregate codeAction results."""
+        lists = [a for item in items if (a := cast(list, item.payload))]
+        # A lone non-empty list can be returned as is.  Never extend
+        # one in place: payloads are reused if the aggregation is
+        # re-sent.
+        if len(lists) == 1:
+            return lists[0]
+        res = []
+        for actions in lists:
+            res.extend(actions)
+        return res
+
+    def _aggregate_completions(self, items: list[PayloadItem]) -> JSON:
+        """Aggregate completion results."""
+
+        def normalize(x):
+            return x if isinstance(x, dict) else {'items': x}
+
+        # FIXME: Deep merging CompletionList properties is wrong
+        # for many fields (e.g., isIncomplete should probably be OR'd)
+        return reduce(
+            lambda acc, item: dmerge_into(acc, normalize(item.payload)),
+            items,
+            {},
+        )
 
-        elif method == 'shutdown':
-            res = {}
+    def _aggregate_initialize(self, items: list[PayloadItem]) -> JSON:
+        """Aggregate initialize results."""
+        merge = self._merge_initialize_payloads
+        return reduce(
+            lambda acc, item: merge(acc, cast(JSON, item.payload), item.server),
+            items,
+            {},
+        )
 
-        else:
-            res = reduce(
-                lambda acc, item: dmerge(acc, cast(JSON, item.payload)),
-                items,
-                {},
-            )
+    def _aggregate_shutdown(self, items: list[PayloadItem]) -> JSON:
+        """Aggregate shutdown results."""
+        return {}
 
-        return (res, False)
+    def _aggregate_default(self, items: list[PayloadItem]) -> JSON:
+        """Aggregate any other payloads by deep merging."""
+        return reduce(
+            lambda acc, item: dmerge_into(acc, cast(JSON, item.payload)),
+            items,
+            {},
+        )
 
     def _merge_initialize_payloads(
         self, aggregate: JSON, payload: JSON, source: Server
     ) -> JSON:
         """Merge initialize response payloads (result objects)."""
 
-        # Determine if this response is from primary
-        primary_payload = source == self.servers[0]
-
         # Merge capabilities by iterating through all keys
-        res = aggregate.get('capabilities', {})
-        new = payload.get('capabilities', {})
-
-        for cap, newval in new.items():
-
-            def t1sync(x):
-                return x == 1 or (isinstance(x, dict) and x.get("change") == 1)
-
-            if res.get(cap) is None:
-                res[cap] = newval
-            elif cap == 'textDocumentSync' and t1sync(newval):
-                res[cap] = newval
-            elif is_scalar(newval) and res.get(cap) is None:
-                res[cap] = newval
-            elif is_scalar(res.get(cap)) and not is_scalar(newval):
-                res[cap] = newval
-            elif (
-                isinstance(res.get(cap), dict)
-                and isinstance(newval, dict)
-                and cap not in ["semanticTokensProvider"]
-            ):
-                # FIXME: This generic merging needs work. For example,
-                # if one server has hoverProvider: true and another
-                # has hoverProvider: {"workDoneProgress": true}, the
-                # result should be {"workDoneProgress": false} to
-                # retain the truish value while not announcing a
-                # capability that one server doesn't support. However,
-                # the correct merging strategy likely varies per
-                # capability.
-                res[cap] = dmerge(res.get(cap), newval)
-
-        aggregate['capabilities'] = res
+        res = aggregate.setdefault('capabilities', {})
+        if new := payload.get('capabilities'):
+            for cap, newval in new.items():
+                if (cur := res.get(cap)) is None:
+                    res[cap] = newval
+                else:
+                    res[cap] = _CAP_MERGERS.get(cap, _merge_cap)(cur, newval)
 
         # Merge serverInfo
-        s_info = payload.get('serverInfo', {})
-        if s_info:
+        if s_info := payload.get('serverInfo'):
+            # Determine if this response is from primary
+            primary_payload = source == self.servers[0]
+            merged_info = aggregate.get('serverInfo') or {}
 
             def merge_field(field: str, s: str) -> str:
-                merged_info = aggregate.get('serverInfo', {})
                 cur = merged_info.get(field, '')
                 new = s_info.get(field, '')
 
@@ -371,14 +478,19 @@ class LspLogic:
         # Return the mutated aggregate
         return aggregate
 
-    def _stash_data_maybe(self, payload: JSON, server: Server):
-        """Stash data field with server ID inline."""
+    def _slot_of(self, server: Server) -> int:
+        """Get the index of server in self.servers, its stash ID."""
+        return next(i for i, s in enumerate(self.servers) if s is server)
+
+    def _stash_data_maybe(self, payload: JSON, slot: int):
+        """Stash data field with server slot inline."""
         # FIXME: investigate why payload can be None
         if not payload or 'data' not in payload:
             return
-        # Replace data with inline dict containing server ID and original data
+        # Replace data with inline dict containing server slot and
+        # original data
         original_data = payload['data']
         payload['data'] = {
-            'frassum-server': id(server),
+            'frassum-server': slot,
             'frassum-data': original_data,
         }
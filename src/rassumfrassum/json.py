@@ -10,6 +10,17 @@ from typing import BinaryIO, cast, Any
 
 JSON = dict[str, Any]
 
+def _decode(content: bytes) -> JSON:
+    """
+    Decode a JSONRPC message body.
+    Interns the method name, as it's compared and hashed repeatedly.
+    """
+    message = cast(JSON, json.loads(content.decode('utf-8')))
+    if isinstance(method := message.get('method'), str):
+        message['method'] = sys.intern(method)
+    return message
+
+
 async def read_message(reader: asyncio.StreamReader) -> JSON | None:
     """
     Read a single JSONRPC message from an async stream.
@@ -36,7 +47,7 @@ async def read_message(reader: asyncio.StreamReader) -> JSON | None:
         return None
 
     content = await reader.readexactly(int(content_length))
-    return cast(JSON, json.loads(content.decode('utf-8')))
+    return _decode(content)
 
 
 async def write_message(writer: asyncio.StreamWriter, message: JSON) -> None:
@@ -72,7 +83,7 @@ def read_message_sync(stream: BinaryIO = sys.stdin.buffer) -> JSON | None:
     if content_length == 0:
         return None
     content = stream.read(content_length)
-    return cast(JSON, json.loads(content.decode('utf-8')))
+    return _decode(content)
 
 
 def write_message_sync(message: JSON, stream : BinaryIO = sys.stdout.buffer) -> None:
@@ -22,7 +22,7 @@ from .json import (
 from .json import (
     write_message as write_lsp_message,
 )
-from .util import event, log, warn, debug
+from .util import LOG_EVENT, event, log, log_enabled, warn, debug
 from .stdio import create_stdin_reader, create_stdout_writer
 
 
@@ -73,6 +73,9 @@ def log_message(direction: str, message: JSON, method: str) -> None:
     """
     Log a JSONRPC message to stderr with extra indications
     """
+    # Avoid serializing the message just to throw it away
+    if not log_enabled(LOG_EVENT):
+        return
     id = message.get("id")
     prefix = method
     if id is not None:
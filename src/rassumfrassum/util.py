@@ -1,5 +1,5 @@
-from datetime import datetime
 import sys
+import time
 
 # Type aliases for presets
 ServerCommand = list[str]
@@ -27,6 +27,11 @@ def get_log_level() -> int:
     """Get the current log level."""
     return _current_log_level
 
+def log_enabled(level: int) -> bool:
+    """Check if messages of this level are logged.
+    Lets callers skip building expensive messages."""
+    return _current_log_level >= level
+
 def set_max_log_length(max_len: int) -> None:
     """Set the maximum log message length (0 = unlimited)."""
     global _max_log_length
@@ -38,13 +43,18 @@ def _truncate(s: str) -> str:
         return s
     return f"{s[:_max_log_length]}... (truncated, {len(s)} bytes total)"
 
+def _timestamp() -> str:
+    """Internal: current local time as HH:MM:SS.mmm."""
+    t = time.time()
+    lt = time.localtime(t)
+    ms = int((t % 1) * 1000)
+    return "%02d:%02d:%02d.%03d" % (lt.tm_hour, lt.tm_min, lt.tm_sec, ms)
+
 def _log(prefix: str, s: str, min_level: int) -> None:
     """Internal: common logging implementation."""
     if _current_log_level < min_level:
         return
-    now = datetime.now()
-    timestamp = now.strftime("%H:%M:%S.%f")[:-3]
-    print(f"{prefix}[{timestamp}] {_truncate(s)}", file=sys.stderr)
+    sys.stderr.write(f"{prefix}[{_timestamp()}] {_truncate(s)}\n")
 
 def info(s: str):
     """Log info-level message (high-level events, lifecycle)."""
@@ -69,31 +79,41 @@ def event(s: str):
 # Alias for backward compatibility
 log = info
 
-def is_scalar(v):
-    return not isinstance(v, (dict, list, set, tuple))
+# Exact container types: JSON payloads only hold built-in types, and
+# set membership is cheaper than isinstance()
+_CONTAINER_TYPES = frozenset((dict, list, set, tuple))
 
-def dmerge(d1: dict, d2: dict):
-    """Merge d2 into d1 destructively.
-    Non-scalars win over scalars; d1 wins on scalar conflicts."""
-
-    result = d1.copy()
-    for key, value in d2.items():
-        if key in result:
-            v1, v2 = result[key], value
-            # Both dicts: recursive merge
-            if isinstance(v1, dict) and isinstance(v2, dict):
-                result[key] = dmerge(v1, v2)
+def is_scalar(v):
+    return type(v) not in _CONTAINER_TYPES
+
+def dmerge_into(d1: dict, d2: dict) -> dict:
+    """Merge d2 into d1 destructively and return d1.
+    Non-scalars win over scalars; d1 wins on scalar conflicts.
+    Only d1 itself is mutated: nested dicts and lists are replaced by
+    merged copies, as they may be shared with other payloads."""
+
+    stack = [(d1, d2)]
+    while stack:
+        result, other = stack.pop()
+        for key, v2 in other.items():
+            if key not in result:
+                result[key] = v2
+                continue
+            v1 = result[key]
+            t1, t2 = type(v1), type(v2)
+            # Both dicts: merge into a copy of v1
+            if t1 is dict and t2 is dict:
+                result[key] = v1 = v1.copy()
+                stack.append((v1, v2))
             # Both lists: concatenate
-            elif isinstance(v1, list) and isinstance(v2, list):
+            elif t1 is list and t2 is list:
                 result[key] = v1 + v2
             # One scalar, one non-scalar: non-scalar wins
-            elif is_scalar(v1) and not is_scalar(v2):
+            elif t1 not in _CONTAINER_TYPES and t2 in _CONTAINER_TYPES:
                 result[key] = v2  # d2's non-scalar wins
-            elif not is_scalar(v1) and is_scalar(v2):
-                result[key] = v1  # d1's non-scalar wins
-            # Both scalars: d1 wins (keep result[key])
-        else:
-            result[key] = value
-    return result
-
+            # Otherwise d1's value wins (keep result[key])
+    return d1
 
+def dmerge(d1: dict, d2: dict):
+    """Merge d2 into a copy of d1, see `dmerge_into'."""
+    return dmerge_into(d1.copy(), d2)